@@ -0,0 +1,32 @@
+# Copyright 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+
+from datasets import Dataset
+
+from verl.utils.dataset import load_self_annotations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", required=True, type=str, help="The json annotation file")
+    parser.add_argument("--image_root", required=True, type=str, help="The folder containing the images")
+    parser.add_argument("--output_path", required=True, type=str, help="The parquet file to write")
+    args = parser.parse_args()
+    assert args.output_path.endswith(".parquet"), "The output_path should end with .parquet."
+
+    annotations = load_self_annotations(args.data_path, args.image_root)
+    Dataset.from_list(annotations).to_parquet(args.output_path)
+    print(f"Saved {len(annotations)} annotations to {args.output_path}.")
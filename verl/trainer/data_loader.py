@@ -13,7 +13,6 @@
 # limitations under the License.
 
 from typing import Optional
-import ipdb
 
 import torch
 from torch.utils.data import RandomSampler, SequentialSampler
@@ -13,7 +13,6 @@
 # limitations under the License.
 
 import json
-import ipdb
 import ray
 from omegaconf import OmegaConf
 
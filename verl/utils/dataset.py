@@ -14,23 +14,50 @@
 
 import math
 import json
-import ipdb
 import os
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from glob import glob
 from io import BytesIO
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
+import pyarrow.parquet as pq
 import torch
 from datasets import load_dataset
-from jinja2 import Template
+from jinja2 import Environment, Template
 from PIL import Image
 from PIL.Image import Image as ImageObject
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
 from transformers import PreTrainedTokenizer, ProcessorMixin
 
 from ..models.transformers.qwen2_vl import get_rope_index
 from . import torch_functional as VF
+from .py_functional import is_package_available
+
+
+if is_package_available("orjson"):
+    import orjson
+
+
+# the fast variant is picked when the processor is loaded with `use_fast=True`
+QWEN2VL_IMAGE_PROCESSORS = ("Qwen2VLImageProcessor", "Qwen2VLImageProcessorFast")
+
+JINJA_ENV = Environment(autoescape=False)
+
+
+@lru_cache
+def get_format_template(format_prompt: str) -> Template:
+    """Compile the format prompt once per process, datasets keep the source so they stay picklable."""
+    return JINJA_ENV.from_string(format_prompt)
+
+
+def _new_shared_tensor(like: torch.Tensor, shape: Tuple[int, ...]) -> torch.Tensor:
+    # allocate in shared memory so sending the batch to the main process needs no extra copy
+    # https://github.com/pytorch/pytorch/blob/v2.6.0/torch/utils/data/_utils/collate.py#L158
+    storage = like._typed_storage()._new_shared(math.prod(shape), device=like.device)
+    return like.new(storage).resize_(*shape)
 
 
 def collate_fn(features: List[Dict[str, Any]]) -> Dict[str, Any]:
@@ -44,30 +71,83 @@ def collate_fn(features: List[Dict[str, Any]]) -> Dict[str, Any]:
                 non_tensors[key].append(value)
 
     for key, value in tensors.items():
-        tensors[key] = torch.stack(value, dim=0)
+        out = None
+        if get_worker_info() is not None:
+            out = _new_shared_tensor(value[0], (len(value), *value[0].shape))
+
+        tensors[key] = torch.stack(value, dim=0, out=out)
+
+    if "position_ids" not in tensors:
+        # the datasets leave 1-D position ids to collate_fn, prompts are left padded so positions start after the pads
+        attention_mask = tensors["attention_mask"]
+        num_pads = (attention_mask == 0).sum(dim=1, keepdim=True)
+        out = None
+        if get_worker_info() is not None:
+            out = _new_shared_tensor(num_pads, attention_mask.shape)
+
+        position_ids = torch.sub(torch.arange(attention_mask.size(1)).unsqueeze(0), num_pads, out=out)
+        tensors["position_ids"] = position_ids.clamp_(min=0)  # (bsz, seq_length)
 
     for key, value in non_tensors.items():
-        non_tensors[key] = np.array(value, dtype=object)
+        # fill a 1-D object array, np.array would build a 2-D array from equal-length lists
+        array = np.empty(len(value), dtype=object)
+        for i, item in enumerate(value):
+            array[i] = item
+
+        non_tensors[key] = array
 
     return {**tensors, **non_tensors}
 
 
 
-def process_image(image: Union[Dict[str, Any], ImageObject, str], min_pixels: int, max_pixels: int) -> ImageObject:
-    if isinstance(image, str):
-        image = Image.open(image)
+def collapse_image_tokens(input_ids: torch.Tensor, image_token_id: int) -> List[int]:
+    """Fold each run of expanded qwen2vl image tokens back into one placeholder, as vllm expects in raw prompt ids."""
+    is_image_token = input_ids == image_token_id
+    is_repeated = torch.zeros_like(is_image_token)
+    is_repeated[1:] = is_image_token[1:] & is_image_token[:-1]
+    return input_ids[~is_repeated].tolist()
+
+
+def load_self_annotations(data_path: str, image_root: str) -> List[Dict[str, Any]]:
+    """Load the json annotations used by `RLHFSelfDataset` into prompt / answer records."""
+    with open(data_path, "rb") as f:
+        temp_annotations = orjson.loads(f.read()) if is_package_available("orjson") else json.load(f)
+
+    annotations = []
+    for ele in temp_annotations:
+        annotations.append(
+            {
+                "images": [os.path.join(image_root, ele["img_id"] + "_origin.png")],
+                "problem": "<image>" + ele["question"],
+                "answer": str(ele["answer"]),
+                "location": ele["location"],
+            }
+        )
+
+    return annotations
+
+
+def process_image(
+    image: Union[Dict[str, Any], ImageObject, str, os.PathLike], min_pixels: int, max_pixels: int
+) -> ImageObject:
+    if isinstance(image, (str, os.PathLike)):
+        image = Image.open(os.fspath(image))
+        # decode once now, pillow closes the file of single-frame images after loading
+        image.load()
     elif isinstance(image, dict):
         image = Image.open(BytesIO(image["bytes"]))
     elif isinstance(image, bytes):
         image = Image.open(BytesIO(image))
 
-    if (image.width * image.height) > max_pixels:
-        resize_factor = math.sqrt(max_pixels / (image.width * image.height))
-        width, height = int(image.width * resize_factor), int(image.height * resize_factor)
-        image = image.resize((width, height))
+    # clamp the area into [min_pixels, max_pixels] with a single resize
+    num_pixels = image.width * image.height
+    resize_factor = None
+    if num_pixels > max_pixels:
+        resize_factor = math.sqrt(max_pixels / num_pixels)
+    elif num_pixels < min_pixels:
+        resize_factor = math.sqrt(min_pixels / num_pixels)
 
-    if (image.width * image.height) < min_pixels:
-        resize_factor = math.sqrt(min_pixels / (image.width * image.height))
+    if resize_factor is not None:
         width, height = int(image.width * resize_factor), int(image.height * resize_factor)
         image = image.resize((width, height))
 
@@ -96,6 +176,8 @@ class RLHFDataset(Dataset):
         max_pixels: Optional[int] = None,
         min_pixels: Optional[int] = None,
         filter_overlong_prompts: bool = True,
+        filter_num_proc: int = 8,
+        num_io_threads: int = 4,
     ):
         self.tokenizer = tokenizer
         self.processor = processor
@@ -107,6 +189,14 @@ class RLHFDataset(Dataset):
         self.max_pixels = max_pixels
         self.min_pixels = min_pixels
         self.filter_overlong_prompts = filter_overlong_prompts
+        self.filter_num_proc = filter_num_proc
+        self.num_io_threads = num_io_threads
+        self._io_pool: Optional[ThreadPoolExecutor] = None
+        self._io_pool_pid: Optional[int] = None
+        self.image_token_id = None
+        if processor is not None and processor.image_processor.__class__.__name__ in QWEN2VL_IMAGE_PROCESSORS:
+            # qwen2vl expands each image placeholder into a single run of the same token, which can be folded back
+            self.image_token_id = tokenizer.convert_tokens_to_ids(processor.image_token)
 
         if "@" in data_path:
             data_path, data_split = data_path.split("@")
@@ -115,9 +205,11 @@ class RLHFDataset(Dataset):
 
         if os.path.isdir(data_path):
             # when we use dataset builder, we should always refer to the train split
-            self.dataset = load_dataset("parquet", data_dir=data_path, split="train")
+            columns = self._get_used_columns(glob(os.path.join(data_path, "**", "*.parquet"), recursive=True))
+            self.dataset = load_dataset("parquet", data_dir=data_path, split="train", columns=columns)
         elif os.path.isfile(data_path):
-            self.dataset = load_dataset("parquet", data_files=data_path, split="train")
+            columns = self._get_used_columns([data_path])
+            self.dataset = load_dataset("parquet", data_files=data_path, split="train", columns=columns)
         else:
             # load remote dataset from huggingface hub
             self.dataset = load_dataset(data_path, split=data_split)
@@ -125,16 +217,43 @@ class RLHFDataset(Dataset):
         self.format_prompt = None
         if format_prompt:
             with open(format_prompt, encoding="utf-8") as f:
-                self.format_prompt = f.read()
+                self.format_prompt = f.read().strip()
+
+        # rendered chat prompts filled by the overlong filter, keyed by the raw prompt
+        self._prompt_cache: Dict[str, str] = {}
 
         if self.filter_overlong_prompts:
-            self.dataset = self.dataset.filter(self._filter_overlong_prompts, desc="Filtering overlong prompts")
+            # map over the prompt column only, so the image bytes are not rewritten to a new cache file
+            prompt_stats = self.dataset.select_columns([self.prompt_key]).map(
+                self._compute_prompt_len,
+                batched=True,
+                batch_size=1000,
+                input_columns=[self.prompt_key],
+                remove_columns=[self.prompt_key],
+                fn_kwargs={"has_image": self.image_key in self.dataset.column_names},
+                # os.cpu_count() reports the whole node inside ray, each process loads its own processor
+                num_proc=min(self.filter_num_proc, max(len(self.dataset) // 1000, 1)),
+                desc="Computing prompt lengths",
+            )
+            prompt_lens, chat_prompts = prompt_stats["prompt_len"], prompt_stats["chat_prompt"]
+            keep_indices = [i for i, prompt_len in enumerate(prompt_lens) if prompt_len <= self.max_prompt_length]
+            # one rendered prompt per kept row, inherited by every forked dataloader worker
+            raw_prompts = self.dataset[self.prompt_key]
+            self._prompt_cache = {raw_prompts[i]: chat_prompts[i] for i in keep_indices}
+            self.dataset = self.dataset.select(keep_indices)
+
+    def _get_used_columns(self, parquet_files: List[str]) -> Optional[List[str]]:
+        """Only read the columns used by the dataset, the others are pruned by the parquet reader."""
+        if len(parquet_files) == 0:
+            return None
+
+        column_names = pq.read_schema(sorted(parquet_files)[0]).names
+        return [key for key in (self.prompt_key, self.answer_key, self.image_key) if key in column_names]
 
     def _build_messages(self, example: Dict[str, Any]) -> List[Dict[str, Any]]:
         prompt_str: str = example[self.prompt_key]
         if self.format_prompt:
-            format_prompt = Template(self.format_prompt.strip())
-            prompt_str = format_prompt.render(content=prompt_str)
+            prompt_str = get_format_template(self.format_prompt).render(content=prompt_str)
 
         if self.image_key in example:
             # https://huggingface.co/docs/transformers/en/tasks/image_text_to_text
@@ -150,11 +269,57 @@ class RLHFDataset(Dataset):
         else:
             return [{"role": "user", "content": prompt_str}]
 
-    def _filter_overlong_prompts(self, example: Dict[str, Any]) -> bool:
-        messages = self._build_messages(example)
-        processing_class = self.processor if self.processor is not None else self.tokenizer
-        return (
-            len(processing_class.apply_chat_template(messages, add_generation_prompt=True)) <= self.max_prompt_length
+    def _build_prompt(self, example: Dict[str, Any]) -> str:
+        prompt = self._prompt_cache.get(example[self.prompt_key])
+        if prompt is None:
+            messages = self._build_messages(example)
+            processing_class = self.processor if self.image_key in example else self.tokenizer
+            prompt = processing_class.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+
+        return prompt
+
+    def _compute_prompt_len(self, prompt_strs: List[str], has_image: bool) -> Dict[str, List[Any]]:
+        chat_prompts = []
+        for prompt_str in prompt_strs:
+            # only the prompt column is read, images are not decoded to build the messages
+            example = {self.prompt_key: prompt_str}
+            if has_image:
+                example[self.image_key] = None
+
+            chat_prompts.append(self._build_prompt(example))
+
+        return {"chat_prompt": chat_prompts, "prompt_len": self._get_prompt_lens(chat_prompts)}
+
+    def _get_prompt_lens(self, chat_prompts: List[str]) -> List[int]:
+        # processors render the chat template to a string, so its length is compared as before
+        if self.processor is not None:
+            return [len(chat_prompt) for chat_prompt in chat_prompts]
+
+        return [len(ids) for ids in self.tokenizer(chat_prompts, add_special_tokens=False)["input_ids"]]
+
+    def __getstate__(self):
+        # thread pools can neither be pickled nor survive a fork, workers create their own
+        state = self.__dict__.copy()
+        state["_io_pool"], state["_io_pool_pid"] = None, None
+        return state
+
+    def _load_images(self, raw_image_data: List[Any]) -> List[ImageObject]:
+        if len(raw_image_data) == 1 or self.num_io_threads <= 1:
+            return [
+                process_image(image, min_pixels=self.min_pixels, max_pixels=self.max_pixels)
+                for image in raw_image_data
+            ]
+
+        if self._io_pool is None or self._io_pool_pid != os.getpid():
+            self._io_pool = ThreadPoolExecutor(max_workers=self.num_io_threads)
+            self._io_pool_pid = os.getpid()
+
+        # PIL releases the GIL while decoding and resampling, so threads overlap the images
+        return list(
+            self._io_pool.map(
+                lambda image: process_image(image, min_pixels=self.min_pixels, max_pixels=self.max_pixels),
+                raw_image_data,
+            )
         )
 
     def __len__(self):
@@ -164,34 +329,35 @@ class RLHFDataset(Dataset):
         example: dict = self.dataset[index]
         # print('in old dataset example:', example)
         # (Runner pid=1177724) example: {'images': [<PIL.PngImagePlugin.PngImageFile image mode=RGBA size=295x206 at 0x7EF19C156920>], 'problem': '<image>Find the measure of $∠Z$ to the nearest tenth.', 'answer': '33.7'}
-        messages = self._build_messages(example)
-        # print('in old dataset messages:', messages)
+        prompt = self._build_prompt(example)
 
         if self.image_key in example:
-            prompt = self.processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
-            raw_image_data = example.pop(self.image_key)
-            images = [
-                process_image(image, min_pixels=self.min_pixels, max_pixels=self.max_pixels)
-                for image in raw_image_data
-            ]
+            raw_image_data = example[self.image_key]
+            images = self._load_images(raw_image_data)
             model_inputs = self.processor(images, [prompt], add_special_tokens=False, return_tensors="pt")
             input_ids = model_inputs.pop("input_ids")[0]
             attention_mask = model_inputs.pop("attention_mask")[0]
+            if self.image_token_id is not None:
+                raw_prompt_ids = collapse_image_tokens(input_ids, self.image_token_id)
+            else:
+                raw_prompt_ids = self.tokenizer.encode(prompt, add_special_tokens=False)
             # print('in old dataset raw_image_data.shape:', len(raw_image_data), type(raw_image_data[0]), np.array(raw_image_data[0]).shape)
             # print('in old dataset model_inputs.keys():', model_inputs.keys())
             # print('in old dataset model_inputs["pixel_values"].shape:', model_inputs['pixel_values'].shape)
             # print('in old dataset model_inputs["image_grid_thw"]:', model_inputs["image_grid_thw"])
             # print('in old dataset attention_mask:', attention_mask.shape)
             # print('in old dataset input_ids:', input_ids.shape)
-            example["multi_modal_data"] = {"image": raw_image_data}
         else:
-            prompt = self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
             model_inputs = self.tokenizer([prompt], add_special_tokens=False, return_tensors="pt")
             input_ids = model_inputs.pop("input_ids")[0]
             attention_mask = model_inputs.pop("attention_mask")[0]
+            raw_prompt_ids = input_ids.tolist()
 
         # print('in old dataset self.processor:', self.processor)
-        if self.processor is not None and self.processor.image_processor.__class__.__name__ == "Qwen2VLImageProcessor":
+        if (
+            self.processor is not None
+            and self.processor.image_processor.__class__.__name__ in QWEN2VL_IMAGE_PROCESSORS
+        ):
             # qwen2vl mrope
             position_ids = get_rope_index(
                 self.processor,
@@ -201,7 +367,7 @@ class RLHFDataset(Dataset):
             )  # (3, seq_length)
             # print('in old dataset position_ids:', position_ids)
         else:
-            position_ids = torch.clip(attention_mask.cumsum(dim=0) - 1, min=0, max=None)  # (seq_length,)
+            position_ids = None  # computed for the whole batch in collate_fn
 
         input_ids, attention_mask, position_ids = VF.postprocess_data(
             input_ids=input_ids,
@@ -212,7 +378,6 @@ class RLHFDataset(Dataset):
             left_pad=True,
             truncation=self.truncation,
         )
-        raw_prompt_ids = self.tokenizer.encode(prompt, add_special_tokens=False)
         if len(raw_prompt_ids) > self.max_prompt_length:
             if self.truncation == "left":
                 raw_prompt_ids = raw_prompt_ids[-self.max_prompt_length :]
@@ -221,12 +386,20 @@ class RLHFDataset(Dataset):
             elif self.truncation == "error":
                 raise RuntimeError(f"Prompt length {len(raw_prompt_ids)} is longer than {self.max_prompt_length}.")
 
-        example["input_ids"] = input_ids
-        example["attention_mask"] = attention_mask
-        example["position_ids"] = position_ids
-        example["raw_prompt_ids"] = raw_prompt_ids
-        example["ground_truth"] = example.pop(self.answer_key)
-        return example
+        # only keep the fields consumed by the trainer, unused columns are not sent to the main process
+        features = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "raw_prompt_ids": raw_prompt_ids,
+            "ground_truth": example[self.answer_key],
+        }
+        if position_ids is not None:
+            features["position_ids"] = position_ids
+
+        if self.image_key in example:
+            features["multi_modal_data"] = {"image": example[self.image_key]}
+
+        return features
 
 # in old dataset
 # (Runner pid=1480555) in old dataset example: {'images': [<PIL.PngImagePlugin.PngImageFile image mode=RGBA size=779x319 at 0x7F5A34176740>], 'problem': '<image>$\\overline{AB} \\perp \\overline{DC}$ and $\\overline{GH} \\perp \\overline{FE}$.\r\nIf $\\triangle ACD \\sim \\triangle GEF$, find $AB$.', 'answer': '2.2'}
@@ -289,6 +462,10 @@ class RLHFSelfDataset(Dataset):
         self.max_pixels = max_pixels
         self.min_pixels = min_pixels
         self.filter_overlong_prompts = filter_overlong_prompts
+        self.image_token_id = None
+        if processor is not None and processor.image_processor.__class__.__name__ in QWEN2VL_IMAGE_PROCESSORS:
+            # qwen2vl expands each image placeholder into a single run of the same token, which can be folded back
+            self.image_token_id = tokenizer.convert_tokens_to_ids(processor.image_token)
 
         if "@" in data_path:
             data_path, data_split = data_path.split("@")
@@ -303,24 +480,23 @@ class RLHFSelfDataset(Dataset):
         # else:
         #     # load remote dataset from huggingface hub
         #     self.dataset = load_dataset(data_path, split=data_split)
-        # load the annotation
-        temp_annotations = json.load(open(data_path))
-        # update the path of the image
-        self.dataset = []
-        for ele in temp_annotations:
-            new_ele = {}
-            new_ele['images'] = [os.path.join(image_root, ele['img_id'] + '_origin.png')]
-            new_ele['problem'] = '<image>' + ele['question']
-            new_ele['answer'] = str(ele['answer'])
-            new_ele['location'] = ele['location']
-            self.dataset.append(new_ele)
-            # example: {'images': [<PIL.PngImagePlugin.PngImageFile image mode=RGBA size=295x206 at 0x7EF19C156920>], 'problem': '<image>Find the measure of $∠Z$ to the nearest tenth.', 'answer': '33.7'}
+        if data_path.endswith(".parquet"):
+            # annotations converted by scripts/convert_annotations.py, memory-mapped by arrow
+            assert image_root is None, "image_root is applied by scripts/convert_annotations.py, unset it for parquet."
+            self.dataset = load_dataset("parquet", data_files=data_path, split="train")
+        else:
+            # load the annotation and update the path of the image
+            self.dataset = load_self_annotations(data_path, image_root)
+        # example: {'images': ['<image_root>/02438_origin.png'], 'problem': '<image>For the subplot ...', 'answer': '0', 'location': [56, 511, 64, 525]}
 
 
         self.format_prompt = None
         if format_prompt:
             with open(format_prompt, encoding="utf-8") as f:
-                self.format_prompt = f.read()
+                self.format_prompt = f.read().strip()
+
+        # rendered chat prompts filled by the overlong filter, keyed by the raw prompt
+        self._prompt_cache: Dict[str, str] = {}
 
         # if self.filter_overlong_prompts:
         #     self.dataset = self.dataset.filter(self._filter_overlong_prompts, desc="Filtering overlong prompts")
@@ -328,8 +504,7 @@ class RLHFSelfDataset(Dataset):
     def _build_messages(self, example: Dict[str, Any]) -> List[Dict[str, Any]]:
         prompt_str: str = example[self.prompt_key]
         if self.format_prompt:
-            format_prompt = Template(self.format_prompt.strip())
-            prompt_str = format_prompt.render(content=prompt_str)
+            prompt_str = get_format_template(self.format_prompt).render(content=prompt_str)
 
         if self.image_key in example:
             # https://huggingface.co/docs/transformers/en/tasks/image_text_to_text
@@ -345,12 +520,26 @@ class RLHFSelfDataset(Dataset):
         else:
             return [{"role": "user", "content": prompt_str}]
 
+    def _build_prompt(self, example: Dict[str, Any]) -> str:
+        prompt = self._prompt_cache.get(example[self.prompt_key])
+        if prompt is None:
+            messages = self._build_messages(example)
+            processing_class = self.processor if self.image_key in example else self.tokenizer
+            prompt = processing_class.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+
+        return prompt
+
     def _filter_overlong_prompts(self, example: Dict[str, Any]) -> bool:
-        messages = self._build_messages(example)
-        processing_class = self.processor if self.processor is not None else self.tokenizer
-        return (
-            len(processing_class.apply_chat_template(messages, add_generation_prompt=True)) <= self.max_prompt_length
-        )
+        prompt = self._build_prompt(example)
+        self._prompt_cache[example[self.prompt_key]] = prompt
+        return self._get_prompt_lens([prompt])[0] <= self.max_prompt_length
+
+    def _get_prompt_lens(self, chat_prompts: List[str]) -> List[int]:
+        # processors render the chat template to a string, so its length is compared as before
+        if self.processor is not None:
+            return [len(chat_prompt) for chat_prompt in chat_prompts]
+
+        return [len(ids) for ids in self.tokenizer(chat_prompts, add_special_tokens=False)["input_ids"]]
 
     def __len__(self):
         return len(self.dataset)
@@ -359,12 +548,10 @@ class RLHFSelfDataset(Dataset):
         example: dict = self.dataset[index]
         # ipdb.set_trace() # check what keys in example
         # print('in new dataset example:', example)
-        messages = self._build_messages(example)
-        # print('in new dataset messages:', messages)
+        prompt = self._build_prompt(example)
 
         if self.image_key in example:
-            prompt = self.processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
-            raw_image_data = example.pop(self.image_key)
+            raw_image_data = example[self.image_key]
             images = [
                 process_image(image, min_pixels=self.min_pixels, max_pixels=self.max_pixels)
                 for image in raw_image_data
@@ -372,21 +559,27 @@ class RLHFSelfDataset(Dataset):
             model_inputs = self.processor(images, [prompt], add_special_tokens=False, return_tensors="pt")
             input_ids = model_inputs.pop("input_ids")[0]
             attention_mask = model_inputs.pop("attention_mask")[0]
+            if self.image_token_id is not None:
+                raw_prompt_ids = collapse_image_tokens(input_ids, self.image_token_id)
+            else:
+                raw_prompt_ids = self.tokenizer.encode(prompt, add_special_tokens=False)
             # print('in new dataset raw_image_data.shape:', len(raw_image_data), type(raw_image_data[0]), np.array(raw_image_data[0]).shape)
             # print('in new dataset model_inputs.keys():', model_inputs.keys())
             # print('in new dataset model_inputs["pixel_values"].shape:', model_inputs['pixel_values'].shape)
             # print('in new dataset model_inputs["image_grid_thw"]:', model_inputs["image_grid_thw"])
             # print('in new dataset attention_mask:', attention_mask.shape)
             # print('in new dataset input_ids:', input_ids.shape)
-            example["multi_modal_data"] = {"image": raw_image_data}
         else:
-            prompt = self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
             model_inputs = self.tokenizer([prompt], add_special_tokens=False, return_tensors="pt")
             input_ids = model_inputs.pop("input_ids")[0]
             attention_mask = model_inputs.pop("attention_mask")[0]
+            raw_prompt_ids = input_ids.tolist()
 
         # print('in new dataset self.processor:', self.processor)
-        if self.processor is not None and self.processor.image_processor.__class__.__name__ == "Qwen2VLImageProcessor":
+        if (
+            self.processor is not None
+            and self.processor.image_processor.__class__.__name__ in QWEN2VL_IMAGE_PROCESSORS
+        ):
             # qwen2vl mrope
             position_ids = get_rope_index(
                 self.processor,
@@ -396,7 +589,7 @@ class RLHFSelfDataset(Dataset):
             )  # (3, seq_length)
             # print('in new dataset position_ids:', position_ids)
         else:
-            position_ids = torch.clip(attention_mask.cumsum(dim=0) - 1, min=0, max=None)  # (seq_length,)
+            position_ids = None  # computed for the whole batch in collate_fn
 
         input_ids, attention_mask, position_ids = VF.postprocess_data(
             input_ids=input_ids,
@@ -407,7 +600,6 @@ class RLHFSelfDataset(Dataset):
             left_pad=True,
             truncation=self.truncation,
         )
-        raw_prompt_ids = self.tokenizer.encode(prompt, add_special_tokens=False)
         if len(raw_prompt_ids) > self.max_prompt_length:
             if self.truncation == "left":
                 raw_prompt_ids = raw_prompt_ids[-self.max_prompt_length :]
@@ -416,10 +608,18 @@ class RLHFSelfDataset(Dataset):
             elif self.truncation == "error":
                 raise RuntimeError(f"Prompt length {len(raw_prompt_ids)} is longer than {self.max_prompt_length}.")
 
-        example["input_ids"] = input_ids
-        example["attention_mask"] = attention_mask
-        example["position_ids"] = position_ids
-        example["raw_prompt_ids"] = raw_prompt_ids
-        example["ground_truth"] = example.pop(self.answer_key)
-        return example
+        # only keep the fields consumed by the trainer, unused columns are not sent to the main process
+        features = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "raw_prompt_ids": raw_prompt_ids,
+            "ground_truth": example[self.answer_key],
+        }
+        if position_ids is not None:
+            features["position_ids"] = position_ids
+
+        if self.image_key in example:
+            features["multi_modal_data"] = {"image": example[self.image_key]}
+
+        return features
 
@@ -153,13 +153,13 @@ def pad_sequence_to_length(
 def postprocess_data(
     input_ids: torch.Tensor,
     attention_mask: torch.Tensor,
-    position_ids: torch.Tensor,
+    position_ids: Optional[torch.Tensor],
     max_length: int,
     pad_token_id: int,
     left_pad: bool = True,
     truncation: Literal["left", "right", "error"] = "error",
 ):
-    """Pad or truncate data."""
+    """Pad or truncate data. The position ids are skipped if None."""
     assert truncation in ["left", "right", "error"]
     seq_length = len(input_ids)
     if seq_length < max_length:
@@ -169,21 +169,31 @@ def postprocess_data(
         attention_mask = pad_sequence_to_length(
             attention_mask, max_seq_len=max_length, pad_token_id=0, left_pad=left_pad
         )
-        position_ids = pad_sequence_to_length(position_ids, max_seq_len=max_length, pad_token_id=0, left_pad=left_pad)
+        if position_ids is not None:
+            position_ids = pad_sequence_to_length(
+                position_ids, max_seq_len=max_length, pad_token_id=0, left_pad=left_pad
+            )
     elif seq_length > max_length:
         if truncation == "left":  # actually, left truncation may not be reasonable
             input_ids = input_ids[..., -max_length:]
             attention_mask = attention_mask[..., -max_length:]
-            position_ids = position_ids[..., -max_length:]
+            if position_ids is not None:
+                position_ids = position_ids[..., -max_length:]
         elif truncation == "right":
             input_ids = input_ids[..., :max_length]
             attention_mask = attention_mask[..., :max_length]
-            position_ids = position_ids[..., :max_length]
+            if position_ids is not None:
+                position_ids = position_ids[..., :max_length]
         elif truncation == "error":
             raise RuntimeError(f"Input sequence length {seq_length} is longer than max length {max_length}.")
         else:
             raise NotImplementedError(f"Unknown truncation method {truncation}.")
 
+        # truncating the last dim of mrope position ids (3, seq_length) leaves a strided view
+        input_ids, attention_mask = input_ids.contiguous(), attention_mask.contiguous()
+        if position_ids is not None:
+            position_ids = position_ids.contiguous()
+
     return input_ids, attention_mask, position_ids
 
 